@@ -0,0 +1,29 @@
+# For the long seqlen_k shapes of test_flash_attn_kvcache, only run a few representative head
+# dimensions: an odd one and the largest / most common ones. This has to be kept in sync with the
+# slow seqlen_q,seqlen_k parametrizations of that test in test_flash_attn.py.
+KVCACHE_TEST_NAME = "test_flash_attn_kvcache"
+KVCACHE_LONG_SEQLEN_K = 128 * 1024
+KVCACHE_LONG_SEQLEN_K_HEADDIMS = {59, 128, 256}
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "slow: long running tests")
+
+
+def pytest_collection_modifyitems(config, items):
+    selected, deselected = [], []
+    for item in items:
+        params = getattr(item, "callspec", None)
+        params = params.params if params is not None else {}
+        if (
+            # Only Function items have originalname, e.g. not doctest items
+            getattr(item, "originalname", None) == KVCACHE_TEST_NAME
+            and params.get("seqlen_k", 0) >= KVCACHE_LONG_SEQLEN_K
+            and params.get("d") not in KVCACHE_LONG_SEQLEN_K_HEADDIMS
+        ):
+            deselected.append(item)
+        else:
+            selected.append(item)
+    if deselected:
+        config.hook.pytest_deselected(items=deselected)
+        items[:] = selected
@@ -1,4 +1,8 @@
+import functools
 import math
+import os
+import random
+from collections import OrderedDict
 
 import pytest
 import torch
@@ -19,6 +23,67 @@ from flash_attn.layers.rotary import apply_rotary_emb
 
 MAX_HEADDIM_SM8x = 192
 
+# Set FLASH_ATTN_TEST_VERBOSE=1 to print the error statistics of the tests with the largest sweeps.
+# Each statistic is a separate reduction and host sync, so they're skipped by default.
+VERBOSE = os.environ.get("FLASH_ATTN_TEST_VERBOSE", "0") == "1"
+
+# The block sizes only depend on the device and a few flags, so avoid querying the device
+# capability on every call.
+_get_block_size_cached = functools.lru_cache(maxsize=None)(_get_block_size)
+
+
+class LRUCache:
+    """Keeps the results of recent calls alive across parametrizations, evicting the least recently
+    used entries once there are more than maxsize of them or they take more than max_bytes.
+    """
+
+    def __init__(self, maxsize=None, max_bytes=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+
+    def get_or_create(self, key, factory, nbytes=0):
+        """Return factory(), reusing the result of a recent call with the same key. nbytes is the
+        size of the result, which is needed before calling factory() so that the evicted entries
+        can be freed first. Results larger than max_bytes are returned without being cached, after
+        freeing all the entries. The cached results are shared between callers, so they must not
+        be modified in-place.
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            self.clear()
+            return factory()
+        while self._entries and (
+            (self.maxsize is not None and len(self._entries) >= self.maxsize)
+            or (self.max_bytes is not None and self._nbytes + nbytes > self.max_bytes)
+        ):
+            _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+            self._nbytes -= evicted_nbytes
+        value = factory()
+        self._entries[key] = (value, nbytes)
+        self._nbytes += nbytes
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self._nbytes = 0
+
+
+_reference_cache = LRUCache(maxsize=4)
+_local_mask_cache = LRUCache(maxsize=4)
+
+
+def cached_reference(key, compute_reference):
+    """Return compute_reference(), reusing the result of a recent call with the same key.
+    The reference outputs usually only depend on a subset of a test's parameters (e.g. not on
+    num_splits), so the key should contain exactly those, and every input of the reference must
+    be a deterministic function of them.
+    """
+    return _reference_cache.get_or_create(key, compute_reference)
+
 
 is_sm75 = torch.cuda.get_device_capability("cuda") == (7, 5)
 is_sm8x = torch.cuda.get_device_capability("cuda")[0] == 8
@@ -36,12 +101,48 @@ def generate_random_padding_mask(max_seqlen, batch_size, device, mode="random"):
         )
     elif mode == "third":
         lengths = torch.randint(max_seqlen // 3, max_seqlen + 1, (batch_size, 1), device=device)
-    padding_mask = (
-        repeat(torch.arange(max_seqlen, device=device), "s -> b s", b=batch_size) < lengths
-    )
+    padding_mask = rearrange(torch.arange(max_seqlen, device=device), "s -> 1 s") < lengths
     return padding_mask
 
 
+def generate_randn_tensors(*shapes, device, dtype, alignment=128, generator=None):
+    """Sample several tensors from the standard normal distribution with a single RNG call.
+    Each tensor is a contiguous view into one buffer, starting at a multiple of alignment elements
+    so that the kernels' vectorized loads stay aligned.
+    """
+    numels = [math.prod(shape) for shape in shapes]
+    offsets = [0]
+    for numel in numels[:-1]:
+        offsets.append(offsets[-1] + (numel + alignment - 1) // alignment * alignment)
+    buffer = torch.randn(offsets[-1] + numels[-1], device=device, dtype=dtype, generator=generator)
+    return [
+        buffer[offset : offset + numel].view(shape)
+        for offset, numel, shape in zip(offsets, numels, shapes)
+    ]
+
+
+_tensor_cache = LRUCache(max_bytes=2 * 2**30)
+
+
+@pytest.fixture(scope="module")
+def tensor_cache():
+    """Cache of test inputs, shared between the parametrizations of a test."""
+    yield _tensor_cache
+    _tensor_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def free_test_caches(request):
+    # A module-scoped fixture is only torn down after the last test of the module, so free the
+    # cached inputs as soon as a test that doesn't use them runs.
+    if "tensor_cache" not in request.fixturenames:
+        _tensor_cache.clear()
+    yield
+    # The local masks are keyed by the identity of the padding masks, which only make sense
+    # within a test.
+    _local_mask_cache.clear()
+
+
 def generate_qkv(
     q, k, v, query_padding_mask=None, key_padding_mask=None, kvpacked=False, qkvpacked=False
 ):
@@ -157,6 +258,40 @@ def construct_local_mask(
     query_padding_mask=None,
     key_padding_mask=None,
     device=None,
+):
+    # The mask only depends on the arguments, so the same tensor is shared between attention_ref,
+    # normalize_flash_attn_S, convert_flash_attn_S_to_softmax and get_dropout_fraction. Callers
+    # must not modify it in-place. The padding masks are keyed by identity, since reading their
+    # lengths would sync with the device, and are kept alive with the entry so that their ids
+    # can't be reused.
+    key = (
+        seqlen_q,
+        seqlen_k,
+        tuple(int(w) for w in window_size),
+        id(query_padding_mask),
+        id(key_padding_mask),
+        None if device is None else torch.device(device),
+    )
+    local_mask, _, _ = _local_mask_cache.get_or_create(
+        key,
+        lambda: (
+            _construct_local_mask(
+                seqlen_q, seqlen_k, window_size, query_padding_mask, key_padding_mask, device
+            ),
+            query_padding_mask,
+            key_padding_mask,
+        ),
+    )
+    return local_mask
+
+
+def _construct_local_mask(
+    seqlen_q,
+    seqlen_k,
+    window_size=(-1, -1),  # -1 means infinite window size
+    query_padding_mask=None,
+    key_padding_mask=None,
+    device=None,
 ):
     row_idx = rearrange(torch.arange(seqlen_q, device=device, dtype=torch.long), "s -> s 1")
     col_idx = torch.arange(seqlen_k, device=device, dtype=torch.long)
@@ -211,23 +346,51 @@ def attention_ref(
             reordering.
     Output:
         output: (batch_size, seqlen_q, nheads, head_dim)
-        attention: (batch_size, nheads, seqlen_q, seqlen_k), softmax after dropout
+        attention: (batch_size, nheads, seqlen_q, seqlen_k), softmax after dropout. None when
+            upcast=True, reorder_ops=False, dropout_p == 0.0, dropout_mask is None and
+            window_size[0] < 0, on Pytorch 2.0+: the output is then computed with
+            F.scaled_dot_product_attention and the attention matrix is not materialized.
     """
     if causal:
         window_size = (window_size[0], 0)
     dtype_og = q.dtype
     if upcast:
         q, k, v = q.float(), k.float(), v.float()
+    if (
+        upcast
+        and not reorder_ops
+        and dropout_p == 0.0
+        and dropout_mask is None
+        and window_size[0] < 0
+        and hasattr(F, "scaled_dot_product_attention")  # Pytorch 2.0+
+    ):
+        output = attention_sdpa_ref(q, k, v, query_padding_mask, key_padding_mask, window_size)
+        return output.to(dtype=dtype_og), None
     seqlen_q, seqlen_k = q.shape[1], k.shape[1]
-    k = repeat(k, "b s h d -> b s (h g) d", g=q.shape[2] // k.shape[2])
-    v = repeat(v, "b s h d -> b s (h g) d", g=q.shape[2] // v.shape[2])
+    # For MQA / GQA, group the query heads that share a KV head instead of materializing
+    # repeated copies of k and v.
+    g = q.shape[2] // k.shape[2]
+    q = rearrange(q, "b t (h g) d -> b t h g d", g=g)
     d = q.shape[-1]
-    if not reorder_ops:
-        scores = torch.einsum("bthd,bshd->bhts", q / math.sqrt(d), k)
-    else:
-        scores = torch.einsum("bthd,bshd->bhts", q, k / math.sqrt(d))
-    if key_padding_mask is not None:
-        scores.masked_fill_(rearrange(~key_padding_mask, "b s -> b 1 1 s"), float("-inf"))
+    # Fold the softmax scaling into the matmul, except with reorder_ops where we scale k
+    # explicitly to change the order of operations.
+    if reorder_ops:
+        k = k / math.sqrt(d)
+    q_bmm = rearrange(q, "b t h g d -> (b h) (g t) d")
+    k_bmm = rearrange(k, "b s h d -> (b h) d s")
+    # With beta=0 the input is ignored, so pass a single element that broadcasts to the output.
+    scores = torch.baddbmm(
+        q_bmm.new_empty(()),
+        q_bmm,
+        k_bmm,
+        beta=0.0,
+        alpha=1.0 if reorder_ops else 1.0 / math.sqrt(d),
+    )
+    scores = rearrange(scores, "(b h) (g t) s -> b (h g) t s", b=q.shape[0], g=g)
+    # Combine the padding and local masks so that scores is only swept once.
+    scores_mask = (
+        rearrange(~key_padding_mask, "b s -> b 1 1 s") if key_padding_mask is not None else None
+    )
     if window_size[0] >= 0 or window_size[1] >= 0:
         local_mask = construct_local_mask(
             seqlen_q,
@@ -237,15 +400,22 @@ def attention_ref(
             key_padding_mask,
             q.device,
         )
-        scores.masked_fill_(local_mask, float("-inf"))
+        scores_mask = local_mask if scores_mask is None else scores_mask | local_mask
+    if scores_mask is not None:
+        scores.masked_fill_(scores_mask, float("-inf"))
     attention = torch.softmax(scores, dim=-1)
     # Some rows might be completely masked out so we fill them with zero instead of NaN
+    attention_mask = None
     if window_size[0] >= 0 or window_size[1] >= 0:
-        attention = attention.masked_fill(torch.all(local_mask, dim=-1, keepdim=True), 0.0)
+        attention_mask = torch.all(local_mask, dim=-1, keepdim=True)
     # We want to mask here so that the attention matrix doesn't have any NaNs
     # Otherwise we'll get NaN in dV
     if query_padding_mask is not None:
-        attention = attention.masked_fill(rearrange(~query_padding_mask, "b s -> b 1 s 1"), 0.0)
+        query_mask = rearrange(~query_padding_mask, "b s -> b 1 s 1")
+        attention_mask = query_mask if attention_mask is None else attention_mask | query_mask
+    # The row masks are OR-ed together first so that attention is only swept once
+    if attention_mask is not None:
+        attention = attention.masked_fill(attention_mask, 0.0)
     dropout_scaling = 1.0 / (1 - dropout_p)
     # attention_drop = attention.masked_fill(~dropout_mask, 0.0) * dropout_scaling
     # output = torch.einsum('bhts,bshd->bthd', attention_drop , v)
@@ -253,12 +423,176 @@ def attention_ref(
         attention_drop = attention.masked_fill(~dropout_mask, 0.0)
     else:
         attention_drop = attention
-    output = torch.einsum("bhts,bshd->bthd", attention_drop, v * dropout_scaling)
+    output = torch.einsum(
+        "bhgts,bshd->bthgd",
+        rearrange(attention_drop, "b (h g) t s -> b h g t s", g=g),
+        v * dropout_scaling,
+    )
+    output = rearrange(output, "b t h g d -> b t (h g) d")
     if query_padding_mask is not None:
         output.masked_fill_(rearrange(~query_padding_mask, "b s -> b s 1 1"), 0.0)
     return output.to(dtype=dtype_og), attention.to(dtype=dtype_og)
 
 
+def attention_sdpa_ref(
+    q,
+    k,
+    v,
+    query_padding_mask=None,
+    key_padding_mask=None,
+    window_size=(-1, -1),  # -1 means infinite window size
+):
+    """Same math as attention_ref without dropout, but through scaled_dot_product_attention so
+    that the (seqlen_q, seqlen_k) scores don't need to be materialized. Requires Pytorch 2.0+.
+    Arguments:
+        q: (batch_size, seqlen_q, nheads, head_dim)
+        k: (batch_size, seqlen_k, nheads_k, head_dim)
+        v: (batch_size, seqlen_k, nheads_k, head_dim)
+        query_padding_mask: (batch_size, seqlen_q)
+        key_padding_mask: (batch_size, seqlen_k)
+        window_size: (int, int), left and right window size. The left window must be infinite.
+    Output:
+        output: (batch_size, seqlen_q, nheads, head_dim)
+    """
+    assert window_size[0] < 0
+    batch_size, seqlen_q, nheads, _ = q.shape
+    seqlen_k = k.shape[1]
+    g = nheads // k.shape[2]
+    mask = rearrange(~key_padding_mask, "b s -> b 1 1 s") if key_padding_mask is not None else None
+    if window_size[1] >= 0:
+        local_mask = construct_local_mask(
+            seqlen_q,
+            seqlen_k,
+            window_size,
+            query_padding_mask,
+            key_padding_mask,
+            q.device,
+        )
+        mask = local_mask if mask is None else mask | local_mask
+    attn_mask = None
+    if mask is not None:
+        mask = mask.expand(batch_size, 1, seqlen_q, seqlen_k)
+        # Rows that are completely masked out would give NaN (in the output and the gradients),
+        # so we let them attend to everything and zero out their output instead.
+        fully_masked = torch.all(mask, dim=-1, keepdim=True)
+        attn_mask = repeat(torch.logical_or(~mask, fully_masked), "b 1 t s -> b 1 (g t) s", g=g)
+    output = F.scaled_dot_product_attention(
+        rearrange(q, "b t (h g) d -> b h (g t) d", g=g),
+        rearrange(k, "b s h d -> b h s d"),
+        rearrange(v, "b s h d -> b h s d"),
+        attn_mask=attn_mask,
+    )
+    output = rearrange(output, "b h (g t) d -> b t (h g) d", g=g)
+    if mask is not None:
+        output = output.masked_fill(rearrange(fully_masked, "b 1 t 1 -> b t 1 1"), 0.0)
+    if query_padding_mask is not None:
+        output = output.masked_fill(rearrange(~query_padding_mask, "b s -> b s 1 1"), 0.0)
+    return output
+
+
+def attention_ref_online_variants(
+    q,
+    k,
+    v,
+    query_padding_mask=None,
+    key_padding_mask=None,
+    causal=False,
+    window_size=(-1, -1),  # -1 means infinite window size
+    variants=((True, False),),
+    tile_n=1024,
+):
+    """Same as attention_ref without dropout, but looping over blocks of tile_n keys with an online
+    softmax (running max and denominator) so that the full (seqlen_q, seqlen_k) scores are never
+    materialized. Useful for very long seqlen_k, e.g. with a KV cache.
+    The output is computed for each (upcast, reorder_ops) in variants in the same pass over k / v,
+    sharing the slicing, masks and fp32 copies of each block. The scores are still computed per
+    variant, since comparing the variants is meant to estimate the error from rounding them.
+    Arguments:
+        q: (batch_size, seqlen_q, nheads, head_dim)
+        k: (batch_size, seqlen_k, nheads_k, head_dim)
+        v: (batch_size, seqlen_k, nheads_k, head_dim)
+        query_padding_mask: (batch_size, seqlen_q)
+        key_padding_mask: (batch_size, seqlen_k)
+        causal: whether to apply causal masking
+        window_size: (int, int), left and right window size
+        variants: list of (upcast, reorder_ops). upcast: whether to cast the inputs to fp32 (one
+            block at a time for k and v). reorder_ops: whether to scale k instead of q.
+        tile_n: number of keys processed per block.
+    Output:
+        outputs: list of (batch_size, seqlen_q, nheads, head_dim), one per variant
+    """
+    if causal:
+        window_size = (window_size[0], 0)
+    dtype_og = q.dtype
+    batch_size, seqlen_q, nheads, d = q.shape
+    seqlen_k, nheads_k = k.shape[1], k.shape[2]
+    g = nheads // nheads_k
+    local_mask = None
+    if window_size[0] >= 0 or window_size[1] >= 0:
+        local_mask = construct_local_mask(
+            seqlen_q,
+            seqlen_k,
+            window_size,
+            query_padding_mask,
+            key_padding_mask,
+            q.device,
+        )
+        if local_mask.dim() == 4:
+            local_mask = rearrange(local_mask, "b 1 t s -> b 1 1 t s")
+    q = rearrange(q, "b t (h g) d -> b t h g d", g=g)
+    qs = []
+    for upcast, reorder_ops in variants:
+        q_i = q.float() if upcast else q
+        qs.append(q_i if reorder_ops else q_i / math.sqrt(d))
+    row_maxs = [
+        torch.full(
+            (batch_size, nheads_k, g, seqlen_q), float("-inf"), device=q.device, dtype=torch.float32
+        )
+        for _ in variants
+    ]
+    row_sums = [torch.zeros_like(row_max) for row_max in row_maxs]
+    accs = [
+        torch.zeros(batch_size, nheads_k, g, seqlen_q, d, device=q.device, dtype=torch.float32)
+        for _ in variants
+    ]
+    for start in range(0, seqlen_k, tile_n):
+        end = min(start + tile_n, seqlen_k)
+        k_tile, v_tile = k[:, start:end], v[:, start:end]
+        if any(upcast for upcast, _ in variants):
+            k_tile_float, v_tile_float = k_tile.float(), v_tile.float()
+        mask = None
+        if key_padding_mask is not None:
+            mask = rearrange(~key_padding_mask[:, start:end], "b s -> b 1 1 1 s")
+        if local_mask is not None:
+            local_mask_tile = local_mask[..., start:end]
+            mask = local_mask_tile if mask is None else mask | local_mask_tile
+        for i, (upcast, reorder_ops) in enumerate(variants):
+            k_i, v_i = (k_tile_float, v_tile_float) if upcast else (k_tile, v_tile)
+            if reorder_ops:
+                k_i = k_i / math.sqrt(d)
+            scores = torch.einsum("bthgd,bshd->bhgts", qs[i], k_i).float()
+            if mask is not None:
+                scores.masked_fill_(mask, float("-inf"))
+            row_max_new = torch.maximum(row_maxs[i], scores.amax(dim=-1))
+            # Rows that are fully masked so far have a max of -inf, use 0 instead to avoid NaN.
+            row_max_safe = row_max_new.masked_fill(row_max_new == float("-inf"), 0.0)
+            rescale = torch.exp(row_maxs[i] - row_max_safe)
+            probs = torch.exp(scores - row_max_safe.unsqueeze(-1))
+            out_tile = torch.einsum("bhgts,bshd->bhgtd", probs.to(dtype=v_i.dtype), v_i).float()
+            row_sums[i] = row_sums[i] * rescale + probs.sum(dim=-1)
+            accs[i] = accs[i] * rescale.unsqueeze(-1) + out_tile
+            row_maxs[i] = row_max_new
+    outputs = []
+    for row_sum, acc in zip(row_sums, accs):
+        # Rows that are completely masked out get zero instead of NaN
+        output = acc / row_sum.masked_fill(row_sum == 0.0, 1.0).unsqueeze(-1)
+        output = rearrange(output, "b h g t d -> b t (h g) d")
+        if query_padding_mask is not None:
+            output.masked_fill_(rearrange(~query_padding_mask, "b s -> b s 1 1"), 0.0)
+        outputs.append(output.to(dtype=dtype_og))
+    return outputs
+
+
 def attention_kvpacked_ref(
     q,
     kv,
@@ -374,7 +708,7 @@ def convert_flash_attn_S_to_softmax(
         window_size = (window_size[0], 0)
     seqlen_q_rounded, seqlen_k_rounded = S.shape[-2:]
     warps_n = 4
-    blocksize_m, blocksize_n = _get_block_size(S.device, head_dim, is_dropout, causal)
+    blocksize_m, blocksize_n = _get_block_size_cached(S.device, head_dim, is_dropout, causal)
     nblocks_n = (seqlen_k_rounded + blocksize_n - 1) // blocksize_n
     nblocks_m = (seqlen_q_rounded + blocksize_m - 1) // blocksize_m
     mmas_n = (blocksize_n + 16 - 1) // 16
@@ -424,8 +758,9 @@ def convert_flash_attn_S_to_softmax(
     if key_padding_mask is not None:
         key_padding_mask = F.pad(key_padding_mask, (0, seqlen_k_rounded - seqlen_k_og))
         S_converted = S_converted.masked_fill(rearrange(~key_padding_mask, "b s -> b 1 1 s"), 0.0)
-    S_converted = F.pad(S_converted, (0, 0, 0, seqlen_q_og - seqlen_q_rounded))
-    S_converted = F.pad(S_converted, (0, seqlen_k_og - seqlen_k_rounded))
+    S_converted = F.pad(
+        S_converted, (0, seqlen_k_og - seqlen_k_rounded, 0, seqlen_q_og - seqlen_q_rounded)
+    )
     return S_converted[:, :, :seqlen_q, :seqlen_k]
 
 
@@ -451,7 +786,8 @@ def normalize_flash_attn_S(
     """
     if causal:
         window_size = (window_size[0], 0)
-    q, k, v = q.float(), k.float(), v.float()
+    # v is not needed to compute the normalization, so only q and k are upcast
+    q, k = q.float(), k.float()
     _, seqlen_q, _, head_dim = q.shape
     seqlen_k = k.shape[1]
     scores = torch.einsum("bthd,bshd->bhts", q / math.sqrt(head_dim), k)
@@ -467,23 +803,34 @@ def normalize_flash_attn_S(
             q.device,
         )
         scores.masked_fill_(local_mask, float("-inf"))
-    _, block_size_n = _get_block_size(scores.device, head_dim, is_dropout, causal)
-    scores_block = scores.split(block_size_n, dim=-1)
-    lse_block = torch.stack([torch.logsumexp(s, dim=-1) for s in scores_block], dim=-1)
+    _, block_size_n = _get_block_size_cached(scores.device, head_dim, is_dropout, causal)
+    # Pad seqlen_k to a multiple of block_size_n so that all blocks can be processed at once
+    # instead of looping over them in Python. F.pad copies even if there's nothing to pad, so
+    # we skip it when seqlen_k is already a multiple of block_size_n.
+    nblocks_n = (seqlen_k + block_size_n - 1) // block_size_n
+    pad_n = nblocks_n * block_size_n - seqlen_k
+    if pad_n > 0:
+        scores = F.pad(scores, (0, pad_n), value=float("-inf"))
+        attn_unnorm_padded = F.pad(attn_unnorm, (0, pad_n))
+    else:
+        attn_unnorm_padded = attn_unnorm
+    scores_block = rearrange(
+        scores, "b h t (n blocksize_n) -> b h t n blocksize_n", blocksize_n=block_size_n
+    )
+    lse_block = torch.logsumexp(scores_block, dim=-1)
     lse = torch.logsumexp(lse_block, dim=-1)
     # lse could be -inf (i.e. all values in scores are -inf), and we want to set those to inf
     # so that when we do torch.exp(m - lse), we get 0.0 instead of NaN.
     lse[lse == float("-inf")] = float("inf")
-    scores_max_block = torch.stack([torch.amax(s, dim=-1) for s in scores_block], dim=-1)
-    cummax_block = torch.cummax(scores_max_block.flip(-1), dim=-1).values.flip(-1).unbind(dim=-1)
-    attn_unnorm_block = attn_unnorm.split(block_size_n, dim=-1)
-    attn_norm = torch.cat(
-        [
-            a * rearrange(torch.exp(m - lse), "b h s -> b h s 1")
-            for a, m in zip(attn_unnorm_block, cummax_block)
-        ],
-        dim=-1,
+    scores_max_block = torch.amax(scores_block, dim=-1)
+    cummax_block = torch.cummax(scores_max_block.flip(-1), dim=-1).values.flip(-1)
+    attn_unnorm_block = rearrange(
+        attn_unnorm_padded, "b h t (n blocksize_n) -> b h t n blocksize_n", blocksize_n=block_size_n
     )
+    attn_norm = rearrange(
+        attn_unnorm_block * torch.exp(cummax_block - lse.unsqueeze(-1)).unsqueeze(-1),
+        "b h t n blocksize_n -> b h t (n blocksize_n)",
+    )[..., :seqlen_k]
     if query_padding_mask is not None:
         attn_norm.masked_fill_(rearrange(~query_padding_mask, "b s -> b 1 s 1"), 0.0)
     return attn_norm.to(dtype=attn_unnorm.dtype)
@@ -523,10 +870,17 @@ def get_dropout_fraction(
         )
         dropped.masked_fill_(local_mask, False)
         valid.masked_fill_(local_mask, False)
-    dropped_total = dropped.sum()
     return dropped.sum() / valid.sum()
 
 
+# Set FLASH_ATTN_COMPILE_REF=1 to run the reference implementations through torch.compile so that
+# the masking / softmax / matmul chain gets fused. It's off by default since each new combination
+# of shapes and flags triggers a recompilation, which costs more than it saves for short runs.
+if os.environ.get("FLASH_ATTN_COMPILE_REF", "0") == "1":
+    attention_ref = torch.compile(attention_ref, dynamic=True)
+    normalize_flash_attn_S = torch.compile(normalize_flash_attn_S, dynamic=True)
+
+
 @pytest.mark.parametrize("dtype", ([torch.float16] if is_sm75 else [torch.float16, torch.bfloat16]))
 # @pytest.mark.parametrize("dtype", [torch.float16])
 @pytest.mark.parametrize("local", [False, True])
@@ -947,7 +1301,6 @@ def test_flash_attn_output(
         print(f"Attention Pytorch max diff: {(attn_pt - attn_ref).abs().max().item()}")
 
     g = torch.randn_like(out)
-    do_o = (g.float() * out.float()).sum(-1)
     if d <= MAX_HEADDIM_SM8x or (is_sm80 or is_sm90):
         if kvpacked:
             (
@@ -1362,7 +1715,6 @@ def test_flash_attn_causal(seqlen_q, seqlen_k, swap_sq_sk, d, local, dtype):
     print(f"Pytorch mean diff: {(out_pt - out_ref).abs().mean().item()}")
 
     g = torch.randn_like(out)
-    do_o = (g.float() * out.float()).sum(-1)
     if d <= MAX_HEADDIM_SM8x or (is_sm80 or is_sm90):
         (
             dq,
@@ -1509,7 +1861,6 @@ def test_flash_attn_varlen_causal(seqlen_q, seqlen_k, swap_sq_sk, d, local, dtyp
     print(f"Pytorch mean diff: {(out_pt - out_ref).abs().mean().item()}")
 
     g = torch.randn_like(out)
-    do_o = (g.float() * out.float()).sum(-1)
     if d <= MAX_HEADDIM_SM8x or (is_sm80 or is_sm90):
         (
             dq_unpad,
@@ -1619,7 +1970,6 @@ def test_flash_attn_splitkv(seqlen_q, seqlen_k, swap_sq_sk, d, causal, local, dt
     print(f"Pytorch mean diff: {(out_pt - out_ref).abs().mean().item()}")
 
     g = torch.randn_like(out)
-    do_o = (g.float() * out.float()).sum(-1)
     if d <= MAX_HEADDIM_SM8x or (is_sm80 or is_sm90):
         (
             dq,
@@ -1695,8 +2045,9 @@ def test_flash_attn_splitkv(seqlen_q, seqlen_k, swap_sq_sk, d, causal, local, dt
         (3, 799),
         (64, 2048),
         (16, 20000),
-        (1, 128 * 1024),
-        (16, 128 * 1024),
+        # For these, tests/conftest.py only runs the head dims in KVCACHE_LONG_SEQLEN_K_HEADDIMS
+        pytest.param(1, 128 * 1024, marks=pytest.mark.slow),
+        pytest.param(16, 128 * 1024, marks=pytest.mark.slow),
         (128, 128),
     ],
 )
@@ -1715,6 +2066,7 @@ def test_flash_attn_kvcache(
     mha_type,
     num_splits,
     dtype,
+    tensor_cache,
 ):
     if seqlen_q > seqlen_k and new_kv:
         pytest.skip()
@@ -1723,6 +2075,7 @@ def test_flash_attn_kvcache(
     device = "cuda"
     # set seed
     torch.random.manual_seed(0)
+    random.seed(0)
     batch_size = 2
     batch_size_cache = batch_size if not has_batch_idx else batch_size * 2
     nheads = 6
@@ -1731,15 +2084,36 @@ def test_flash_attn_kvcache(
     nheads_k = nheads if mha_type == "mha" else (1 if mha_type == "mqa" else 3)
     assert nheads % nheads_k == 0
     window_size = (-1, -1) if not local else torch.randint(0, seqlen_k, (2,))
-    q = torch.randn(batch_size, seqlen_q, nheads, d, device=device, dtype=dtype)
-    seqlen_new = seqlen_q if seqlen_new_eq_seqlen_q else torch.randint(1, seqlen_q + 1, (1,)).item()
+    seqlen_new = seqlen_q if seqlen_new_eq_seqlen_q else random.randint(1, seqlen_q)
+    shapes = [
+        (batch_size, seqlen_q, nheads, d),
+        (batch_size_cache, seqlen_k, nheads_k, d),
+        (batch_size_cache, seqlen_k, nheads_k, d),
+        *([(batch_size, seqlen_new, nheads_k, d)] * 2 if new_kv else []),
+    ]
+
+    # Many parametrizations share the same input shapes, so the inputs are cached. They're drawn
+    # from their own generator so that the global RNG, and hence everything else sampled in this
+    # test, is the same whether or not the inputs come from the cache.
+    def generate_inputs():
+        return generate_randn_tensors(
+            *shapes,
+            device=device,
+            dtype=dtype,
+            generator=torch.Generator(device=device).manual_seed(0),
+        )
+
     if new_kv:
-        k = torch.randn(batch_size, seqlen_new, nheads_k, d, device=device, dtype=dtype)
-        v = torch.randn(batch_size, seqlen_new, nheads_k, d, device=device, dtype=dtype)
+        # The kernel appends k and v to the cache in-place, so cached inputs would have to be
+        # copied anyway.
+        q, k_cache, v_cache, k, v = generate_inputs()
     else:
+        q, k_cache, v_cache = tensor_cache.get_or_create(
+            (tuple(shapes), dtype),
+            generate_inputs,
+            nbytes=sum(math.prod(shape) for shape in shapes) * torch.finfo(dtype).bits // 8,
+        )
         k, v = None, None
-    k_cache = torch.randn(batch_size_cache, seqlen_k, nheads_k, d, device=device, dtype=dtype)
-    v_cache = torch.randn(batch_size_cache, seqlen_k, nheads_k, d, device=device, dtype=dtype)
     cache_seqlens = torch.randint(
         0,
         # If we don't use seqlen_q in the case of causal and rotary, cos/sin won't be long enough
@@ -1751,6 +2125,8 @@ def test_flash_attn_kvcache(
         device=device,
     )
     if has_batch_idx:
+        # The indices have to be unique: with new_kv the kernel appends to the indexed cache
+        # entries in-place, so two sequences sharing an entry would race with each other.
         cache_batch_idx = torch.randperm(batch_size_cache, dtype=torch.int32, device=device)[:batch_size]
     else:
         cache_batch_idx = None
@@ -1764,6 +2140,9 @@ def test_flash_attn_kvcache(
                 q, cos, sin, seqlen_offsets=cache_seqlens, interleaved=rotary_interleaved
             )
         else:
+            # Without causal / local, all the queries of a sequence are rotated by the position
+            # cache_seqlens, so seqlen_q is folded into the heads. q and the output of
+            # apply_rotary_emb are contiguous, so both rearranges are views and don't copy.
             q_ro = rearrange(
                 apply_rotary_emb(
                     rearrange(q, "b s h d -> b 1 (s h) d"),
@@ -1783,8 +2162,13 @@ def test_flash_attn_kvcache(
         cos, sin = None, None
         q_ro, k_ro = q, k
     # k_cache[:, 64:] = -1
-    k_cache_ref = (k_cache if not has_batch_idx else k_cache[cache_batch_idx]).clone()
-    v_cache_ref = (v_cache if not has_batch_idx else v_cache[cache_batch_idx]).clone()
+    # The reference cache only needs its own copy if the kernel appends new_kv to k_cache / v_cache
+    # in-place. Advanced indexing already returns a copy.
+    if has_batch_idx:
+        k_cache_ref, v_cache_ref = k_cache[cache_batch_idx], v_cache[cache_batch_idx]
+    else:
+        k_cache_ref = k_cache.clone() if new_kv else k_cache
+        v_cache_ref = v_cache.clone() if new_kv else v_cache
     arange = rearrange(torch.arange(seqlen_k, device=device), "s -> 1 s")
     cache_seqlens_expanded = rearrange(cache_seqlens, "b -> b 1")
     if new_kv:
@@ -1793,8 +2177,6 @@ def test_flash_attn_kvcache(
         )
         k_cache_ref[update_mask] = rearrange(k_ro, "b s ... -> (b s) ...")
         v_cache_ref[update_mask] = rearrange(v, "b s ... -> (b s) ...")
-    k_cache_rep = repeat(k_cache_ref, "b s h d -> b s (h g) d", g=nheads // nheads_k)
-    v_cache_rep = repeat(v_cache_ref, "b s h d -> b s (h g) d", g=nheads // nheads_k)
     out = flash_attn_with_kvcache(
         q,
         k_cache,
@@ -1821,34 +2203,50 @@ def test_flash_attn_kvcache(
     # lse_ref = torch.logsumexp(qk / math.sqrt(d), -1)
     # probs = torch.softmax(qk, dim=-1)
     key_padding_mask = arange < cache_seqlens_expanded + (seqlen_new if new_kv else 0)
-    out_ref, _ = attention_ref(
-        q_ro,
-        k_cache_rep,
-        v_cache_rep,
-        None,
-        key_padding_mask,
-        0.0,
-        None,
-        causal=causal,
-        window_size=window_size,
-    )
-    out_pt, _ = attention_ref(
-        q_ro,
-        k_cache_rep,
-        v_cache_rep,
-        None,
-        key_padding_mask,
-        0.0,
-        None,
-        causal=causal,
-        window_size=window_size,
-        upcast=False,
-        reorder_ops=True,
+
+    # seqlen_k goes up to 128k, so use the reference that doesn't materialize the scores. The
+    # upcast reference and the reordered Pytorch one are computed in the same pass over k / v.
+    def compute_reference():
+        return attention_ref_online_variants(
+            q_ro,
+            k_cache_ref,
+            v_cache_ref,
+            None,
+            key_padding_mask,
+            causal=causal,
+            window_size=window_size,
+            variants=[(True, False), (False, True)],
+        )
+
+    # The reference doesn't depend on num_splits, and the two num_splits parametrizations run
+    # right after each other, so the second one reuses the first one's reference outputs.
+    out_ref, out_pt = cached_reference(
+        (
+            "kvcache",
+            seqlen_q,
+            seqlen_k,
+            d,
+            has_batch_idx,
+            rotary_fraction,
+            rotary_interleaved,
+            seqlen_new_eq_seqlen_q,
+            causal,
+            local,
+            new_kv,
+            mha_type,
+            dtype,
+            torch.random.initial_seed(),
+        ),
+        compute_reference,
     )
-    print(f"Output max diff: {(out - out_ref).abs().max().item()}")
-    print(f"Output mean diff: {(out - out_ref).abs().mean().item()}")
-    print(f"Pytorch max diff: {(out_pt - out_ref).abs().max().item()}")
-    print(f"Pytorch mean diff: {(out_pt - out_ref).abs().mean().item()}")
+    # Compute each error once, and copy both maxima to the host with a single sync
+    out_diff, out_pt_diff = (out - out_ref).abs(), (out_pt - out_ref).abs()
+    out_max_diff, out_pt_max_diff = torch.stack([out_diff.max(), out_pt_diff.max()]).tolist()
+    if VERBOSE:
+        print(f"Output max diff: {out_max_diff}")
+        print(f"Output mean diff: {out_diff.mean().item()}")
+        print(f"Pytorch max diff: {out_pt_max_diff}")
+        print(f"Pytorch mean diff: {out_pt_diff.mean().item()}")
 
     # Check that FlashAttention's numerical error is at most twice the numerical error
     # of a Pytorch implementation.
@@ -1857,7 +2255,7 @@ def test_flash_attn_kvcache(
         v_cache_select = v_cache if not has_batch_idx else v_cache[cache_batch_idx]
         assert torch.allclose(k_cache_select, k_cache_ref, rtol=1e-3, atol=1e-3)
         assert torch.equal(v_cache_select, v_cache_ref)
-    assert (out - out_ref).abs().max().item() <= 3 * (out_pt - out_ref).abs().max().item() + 1e-5
+    assert out_max_diff <= 3 * out_pt_max_diff + 1e-5
 
 
 # @pytest.mark.parametrize("dtype", ([torch.float16] if is_sm75 else [torch.float16, torch.bfloat16]))